@@ -1,8 +1,11 @@
 # list_soil_biomes_turbo.py
 # pip install requests
 
-import requests, time, sys, json, collections
+import requests, time, sys, json, functools
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 BASE = "https://www.ebi.ac.uk/metagenomics/api/v1"
 ROOT = "root:Environmental:Terrestrial:Soil"
@@ -13,18 +16,44 @@ GLOBAL_TIME_LIMIT = 120         # общий лимит на обход (сек)
 MAX_DEPTH         = 2           # глубина: 0=Soil, 1=дети Soil, 2=внуки
 MAX_PAGES_PER_NODE= 5           # страниц children на один узел
 PAGE_SIZE         = 100         # просим больше объектов на страницу (сервер может игнорить)
+FRONTIER_WORKERS  = 16          # узлов одного уровня BFS, запрашиваемых параллельно
+CACHE_PATH        = "mgnify_cache.sqlite"  # кэш JSON-ответов API между запусками
+CACHE_TTL         = 86400       # сек; ETag/Last-Modified перепроверяются по cache_control
 # --------------------------------------
 
-session = requests.Session()
+try:
+    import requests_cache  # pip install requests-cache (необязательно)
+    session = requests_cache.CachedSession(CACHE_PATH, backend="sqlite", expire_after=CACHE_TTL,
+                                           allowable_methods=("GET",), allowable_codes=(200,),
+                                           cache_control=True)
+except ImportError:
+    session = requests.Session()
 session.headers.update({"Accept":"application/json"})
+# весь трафик идёт на один хост (www.ebi.ac.uk): пул под параллельные запросы,
+# повторы 429/5xx с экспоненциальной паузой делает urllib3
+session.mount("https://", HTTPAdapter(
+    pool_connections=1, pool_maxsize=32,
+    max_retries=Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])))
+
+try:
+    import orjson  # pip install orjson (необязательно): разбор JSON в разы быстрее stdlib
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+@functools.lru_cache(maxsize=1024)
+def _quote(s):
+    # lineage/id → сегмент пути; одни и те же строки кодируются многократно
+    return quote(s, safe="")
 
 def get_json(url, params=None):
     r = session.get(url, params=params, timeout=TIMEOUT_S)
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
 
 def iter_children_pages(lineage):
-    url = f"{BASE}/biomes/{quote(lineage, safe='')}/children"
+    url = f"{BASE}/biomes/{_quote(lineage)}/children"
     params = {"page_size": PAGE_SIZE}
     pages = 0
     while url and pages < MAX_PAGES_PER_NODE:
@@ -34,6 +63,16 @@ def iter_children_pages(lineage):
         params = None
         pages += 1
 
+def fetch_all_children_pages(lineage):
+    # -> (pages, error): ошибку не бросаем, чтобы один узел не ронял весь уровень
+    pages = []
+    try:
+        for page in iter_children_pages(lineage):
+            pages.append(page)
+    except Exception as e:
+        return pages, e
+    return pages, None
+
 def crawl_soil(max_depth=MAX_DEPTH, global_time_limit=GLOBAL_TIME_LIMIT):
     start = time.time()
     seen = set([ROOT])
@@ -42,46 +81,46 @@ def crawl_soil(max_depth=MAX_DEPTH, global_time_limit=GLOBAL_TIME_LIMIT):
 
     # добавим сам ROOT (одним запросом, чтобы знать его имя/счётчик)
     try:
-        root_obj = get_json(f"{BASE}/biomes/{quote(ROOT, safe='')}")
+        root_obj = get_json(f"{BASE}/biomes/{_quote(ROOT)}")
         ra = (root_obj.get("data") or {}).get("attributes") or {}
         biomes[ra.get("biome-name","Soil")] = {"lineage": ROOT, "samples": ra.get("samples-count")}
     except Exception:
         pass
 
-    Q = collections.deque([(ROOT, 0)])
+    frontier = [ROOT]  # узлы текущего уровня; уровни обходим строго по порядку
     requests_done = 0
 
-    while Q:
-        if global_time_limit and time.time() - start > global_time_limit:
-            print(f"[!] Прервано по лимиту времени {global_time_limit}s", file=sys.stderr)
-            break
-
-        lineage, depth = Q.popleft()
-        if depth >= max_depth:
-            continue
-
-        try:
-            for page in iter_children_pages(lineage):
-                requests_done += 1
-                for item in (page.get("data") or []):
-                    attrs = item.get("attributes") or {}
-                    child_lin = attrs.get("lineage")
-                    name = attrs.get("biome-name") or (child_lin.split(":")[-1] if child_lin else None)
-                    samples = attrs.get("samples-count")
-                    if not child_lin or child_lin in seen:
-                        continue
-                    seen.add(child_lin)
-                    # запишем сразу без доп. запросов
-                    biomes[name] = {"lineage": child_lin, "samples": samples}
-                    # пойдём глубже
-                    Q.append((child_lin, depth+1))
-        except requests.HTTPError as e:
-            # не валимся на 404/500: просто пропустим узел
-            print(f"[skip] children of {lineage} -> {e}", file=sys.stderr)
-            continue
-        except Exception as e:
-            print(f"[skip] {lineage} -> {e}", file=sys.stderr)
-            continue
+    with ThreadPoolExecutor(max_workers=FRONTIER_WORKERS) as pool:
+        for depth in range(max_depth):
+            if not frontier:
+                break
+            if global_time_limit and time.time() - start > global_time_limit:
+                print(f"[!] Прервано по лимиту времени {global_time_limit}s", file=sys.stderr)
+                break
+
+            # children всех узлов уровня тянем параллельно
+            next_frontier = []
+            for lineage, (pages, err) in zip(frontier, pool.map(fetch_all_children_pages, frontier)):
+                requests_done += len(pages)
+                for page in pages:
+                    for item in (page.get("data") or []):
+                        attrs = item.get("attributes") or {}
+                        child_lin = attrs.get("lineage")
+                        name = attrs.get("biome-name") or (child_lin.split(":")[-1] if child_lin else None)
+                        samples = attrs.get("samples-count")
+                        if not child_lin or child_lin in seen:
+                            continue
+                        seen.add(child_lin)
+                        # запишем сразу без доп. запросов
+                        biomes[name] = {"lineage": child_lin, "samples": samples}
+                        # пойдём глубже
+                        next_frontier.append(child_lin)
+                if isinstance(err, requests.HTTPError):
+                    # не валимся на 404/500: просто пропустим узел
+                    print(f"[skip] children of {lineage} -> {err}", file=sys.stderr)
+                elif err is not None:
+                    print(f"[skip] {lineage} -> {err}", file=sys.stderr)
+            frontier = next_frontier
 
     # упорядочим по числу сэмплов
     order = sorted(
@@ -90,13 +129,15 @@ def crawl_soil(max_depth=MAX_DEPTH, global_time_limit=GLOBAL_TIME_LIMIT):
     )
     return order, biomes, {"requests": requests_done, "elapsed_s": round(time.time()-start,2)}
 
+# пробел/дефис/слэш → "_", скобки выкидываем — одним проходом str.translate
+_SLUG_TABLE = str.maketrans({" ": "_", "-": "_", "/": "_", "(": None, ")": None})
+
 def emit_dict(biomes, min_samples=50):
     # делаем красивый python-словарь для вставки в код
     lines = ["BIOMES = {"]
     used = set()
     def slug(s):
-        return (s.lower().replace(" ","_").replace("-","_").replace("/","_")
-                .replace("(","").replace(")","").replace("__","_"))
+        return s.lower().translate(_SLUG_TABLE).replace("__","_")
     for name, info in sorted(biomes.items(), key=lambda kv: (-(kv[1]["samples"] or 0), kv[0])):
         s = info["samples"]
         if s is None or s < min_samples: 
@@ -1,46 +1,264 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, sys, time, shutil, subprocess
-from urllib.parse import quote
+import os, sys, time, json, csv, shutil, subprocess, threading, collections, contextlib, functools
+import multiprocessing
+import io, socket, ssl, http.client
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor, Future,
+                                as_completed, wait, FIRST_COMPLETED)
+from urllib.parse import quote, urlencode, urlsplit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 BASE = "https://www.ebi.ac.uk/metagenomics/api/v1"
 OUT_DIR = "biom_data"
 TARGET_PER_CLASS = 200
 REQ_TIMEOUT = 60
-SLEEP = 0.05
 MAX_SAMPLE_PAGES     = 120
 MAX_RUNS_PER_SAMPLE  = 12
 MAX_ANALYSES_PER_RUN = 12
 CLASS_TIME_LIMIT     = None  # None чтобы снять лимит
+SAMPLE_WORKERS       = 16    # потоков, продвигающих сэмплы по стадиям sample→run→analysis
+CONVERT_WORKERS      = max(1, (os.cpu_count() or 2) // 2)  # процессов под TSV→BIOM
+CACHE_PATH           = "mgnify_cache.sqlite"  # кэш JSON-ответов API между запусками
+CACHE_TTL            = 86400  # сек; ETag/Last-Modified перепроверяются по cache_control
+API_CONCURRENCY      = (4, 1, 32)  # стартовое / мин / макс число одновременных JSON-запросов
+JSON_MEMO_SIZE       = 4096   # сколько разобранных JSON-ответов держать в памяти процесса
+DNS_TTL              = 3600   # сек: адрес API резолвится раз в час, а не на каждое переподключение
+PROFILE_OUT          = os.environ.get("MGNIFY_PROFILE")  # файл для cProfile (смотреть: snakeviz <файл>)
+RUN_EXPERIMENT_TYPE  = None   # напр. "amplicon": фильтр runs на стороне API; None — все типы
+INCLUDE_RELATED      = True   # runs+analyses сэмпла одним запросом (?include=), см. fetch_runs_with_analyses
 
 BIOMES = {
     "forest":       "root:Environmental:Terrestrial:Soil:Forest soil",
 }
 
-session = requests.Session()
+try:
+    import requests_cache  # pip install requests-cache (необязательно)
+    session = requests_cache.CachedSession(CACHE_PATH, backend="sqlite", expire_after=CACHE_TTL,
+                                           allowable_methods=("GET",), allowable_codes=(200,),
+                                           cache_control=True)
+except ImportError:
+    session = requests.Session()
 session.headers.update({"Accept": "application/json"})
+# весь трафик идёт на один хост (www.ebi.ac.uk): пул под параллельные запросы,
+# повторы 429/5xx с экспоненциальной паузой делает urllib3
+adapter = HTTPAdapter(
+    pool_connections=1, pool_maxsize=32,
+    max_retries=Retry(total=5, backoff_factor=0.5, respect_retry_after_header=True,
+                      status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET", "HEAD"]))
+# BIOM/TSV — крупные бинарники: качаем мимо кэша, через тот же пул соединений
+dl_session = requests.Session()
+for sess in (session, dl_session):
+    sess.mount("https://", adapter)
+# без дискового кэша JSON-запросы к API идут напрямую через http.client (см. _raw_get_json).
+# http.client не знает про HTTPS_PROXY/NO_PROXY и REQUESTS_CA_BUNDLE — при прокси или
+# своём CA оставляем всё на requests; корневые сертификаты те же, что у requests (certifi)
+RAW_HTTP = (not hasattr(session, "cache")
+            and not requests.utils.get_environ_proxies(BASE)
+            and not (os.environ.get("REQUESTS_CA_BUNDLE") or os.environ.get("CURL_CA_BUNDLE")))
+_raw_ssl = ssl.create_default_context(cafile=requests.certs.where()) if RAW_HTTP else None
 os.makedirs(OUT_DIR, exist_ok=True)
 
-def get_json(url, params=None, retries=5):
-    for a in range(retries):
+try:
+    import ijson  # pip install ijson (необязательно): потоковый разбор страниц samples
+except ImportError:
+    ijson = None
+
+try:
+    import orjson  # pip install orjson (необязательно): разбор JSON в разы быстрее stdlib
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+@functools.lru_cache(maxsize=1024)
+def _quote(s):
+    # lineage/id → сегмент пути; одни и те же строки кодируются многократно
+    return quote(s, safe="")
+
+class AdaptiveLimiter:
+    """
+    Vegas-подобный ограничитель числа одновременных запросов к API.
+    По минимальному RTT оцениваем «очередь» на сервере:
+    queue = limit * (1 - min_rtt / rtt). Мала — добавляем слот, велика — убираем.
+    429 с Retry-After urllib3 отрабатывает внутри session.get, поэтому давление
+    сервера видно здесь как рост RTT, и лимит сам сжимается.
+    """
+    ALPHA, BETA = 2, 4
+
+    def __init__(self, initial, min_limit, max_limit):
+        self.limit, self.min_limit, self.max_limit = initial, min_limit, max_limit
+        self.in_flight = 0
+        self.min_rtt = None
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def use(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+        t0 = time.monotonic()
+        probe = {"count": True}  # вызывающий сбросит, если ответ не из сети (кэш)
         try:
-            r = session.get(url, params=params, timeout=REQ_TIMEOUT)
-            if r.status_code == 429:
-                time.sleep(3 + a); continue
-            r.raise_for_status()
-            return r.json()
-        except Exception as e:
-            if a == retries - 1: raise
-            time.sleep(1 + a)
+            yield probe
+        finally:
+            rtt = time.monotonic() - t0
+            with self.cond:
+                self.in_flight -= 1
+                if probe["count"]: self._update(rtt)
+                self.cond.notify_all()
+
+    def _update(self, rtt):
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        queue = self.limit * (1 - self.min_rtt / rtt) if rtt > 0 else 0
+        if queue < self.ALPHA:
+            self.limit = min(self.max_limit, self.limit + 1)
+        elif queue > self.BETA:
+            self.limit = max(self.min_limit, self.limit - 1)
+
+api_limiter = AdaptiveLimiter(*API_CONCURRENCY)
+
+API_HOST = urlsplit(BASE).netloc
+_raw_conns = threading.local()
+
+# весь трафик — на один хост: после обрыва соединения (429/backoff) urllib3 и
+# http.client снова зовут getaddrinfo; для API_HOST отдаём ответ из кэша на DNS_TTL
+_getaddrinfo = socket.getaddrinfo
+_dns_cache = {}
+_dns_lock = threading.Lock()
+
+def _cached_getaddrinfo(host, *args, **kwargs):
+    if host != API_HOST:
+        return _getaddrinfo(host, *args, **kwargs)
+    key = (args, tuple(sorted(kwargs.items())))
+    now = time.monotonic()
+    with _dns_lock:
+        hit = _dns_cache.get(key)
+    if hit and now - hit[0] < DNS_TTL:
+        return hit[1]
+    res = _getaddrinfo(host, *args, **kwargs)
+    with _dns_lock:
+        _dns_cache[key] = (now, res)
+    return res
+
+socket.getaddrinfo = _cached_getaddrinfo
+
+def _raw_get_json(url, params=None):
+    """
+    GET к API по долгоживущему http.client.HTTPSConnection (одно на поток) в обход
+    requests/urllib3: на горячем пути профиль показывал разбор URL (parse_url)
+    и выбор пула на каждый запрос. Всё, что не «200 с хоста API», возвращает None —
+    тогда вызывающий идёт обычным путём через session (ретраи 429/5xx, редиректы).
+    Сбой на свежем соединении (connect/TLS/таймаут) выключает путь до конца запуска.
+    """
+    global RAW_HTTP
+    parts = urlsplit(url)
+    if parts.scheme != "https" or parts.netloc != API_HOST:
+        return None
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    if params:
+        path += ("&" if parts.query else "?") + urlencode(params)
+    for _ in range(2):  # второй заход — если сервер закрыл keep-alive соединение
+        conn = getattr(_raw_conns, "conn", None)
+        fresh = conn is None
+        if fresh:
+            conn = _raw_conns.conn = http.client.HTTPSConnection(API_HOST, timeout=REQ_TIMEOUT,
+                                                                 context=_raw_ssl)
+        try:
+            conn.request("GET", path, headers={"Accept": "application/json"})
+            resp = conn.getresponse()
+            body = resp.read()
+        except (http.client.HTTPException, OSError) as e:  # ssl.SSLError — тоже OSError
+            conn.close(); _raw_conns.conn = None
+            if fresh:
+                # не старое keep-alive, а сеть/TLS: дальше не пытаемся, как с INCLUDE_RELATED
+                RAW_HTTP = False
+                print(f"[info] прямой http.client к {API_HOST} недоступен ({e}) — через requests",
+                      file=sys.stderr)
+                return None
+            continue
+        return json_loads(body) if resp.status == 200 else None
+    return None
+
+def _fetch_json(url, params=None):
+    with api_limiter.use() as probe:
+        if RAW_HTTP:
+            data = _raw_get_json(url, params)
+            if data is not None:
+                return data
+        r = session.get(url, params=params, timeout=REQ_TIMEOUT)
+        probe["count"] = not getattr(r, "from_cache", False)
+    r.raise_for_status()
+    return json_loads(r.content)
+
+# url+params -> Future: одинаковые запросы, в том числе одновременные из разных
+# цепочек, уходят в сеть один раз; последние JSON_MEMO_SIZE ответов остаются в памяти
+_json_memo = collections.OrderedDict()
+_json_memo_lock = threading.Lock()
+
+def get_json(url, params=None):
+    key = url + "?" + urlencode(sorted(params.items())) if params else url
+    with _json_memo_lock:
+        fut = _json_memo.get(key)
+        owner = fut is None
+        if owner:
+            fut = _json_memo[key] = Future()
+            if len(_json_memo) > JSON_MEMO_SIZE:
+                _json_memo.popitem(last=False)
+        else:
+            _json_memo.move_to_end(key)
+    if not owner:
+        return fut.result()
+    try:
+        fut.set_result(_fetch_json(url, params))
+    except BaseException as e:
+        # ошибку не кэшируем: следующий вызов попробует заново
+        with _json_memo_lock:
+            if _json_memo.get(key) is fut: del _json_memo[key]
+        fut.set_exception(e)
+        raise
+    return fut.result()
 
-def iter_pages(url, params=None):
-    while url:
-        data = get_json(url, params=params)
-        if not data: break
-        yield data
-        url = (data.get("links") or {}).get("next")
+def iter_pages(url, params=None, fetch=get_json):
+    # следующая страница запрашивается в фоне, пока вызывающий разбирает текущую
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        data = fetch(url, params=params) if url else None
+        while data:
+            next_url = (data.get("links") or {}).get("next")
+            fut = prefetch.submit(fetch, next_url) if next_url else None
+            yield data
+            data = fut.result() if fut else None
+
+def get_samples_page(url, params=None):
+    """
+    Страница samples, разобранная потоково через ijson: из тяжёлых attributes/
+    relationships в dict попадают только id сэмпла, ссылка на его runs и links.next.
+    Без ijson — обычный get_json.
+    """
+    if ijson is None:
+        return get_json(url, params)
+    with api_limiter.use():
+        r = session.get(url, params=params, stream=True, timeout=REQ_TIMEOUT)
+    with r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        # CachedSession уже вычитал тело в кэш — тогда разбираем его из памяти
+        src = io.BytesIO(r.content) if hasattr(session, "cache") else r.raw
+        items, next_url, cur = [], None, None
+        for prefix, event, value in ijson.parse(src, use_float=True):
+            if prefix == "data.item" and event == "start_map":
+                cur = {"id": None, "relationships": {"runs": {"links": {"related": None}}}}
+                items.append(cur)
+            elif prefix == "data.item.id":
+                cur["id"] = value
+            elif prefix == "data.item.relationships.runs.links.related":
+                cur["relationships"]["runs"]["links"]["related"] = value
+            elif prefix == "links.next":
+                next_url = value
+    return {"data": items, "links": {"next": next_url}}
 
 def ensure_unique_path(dirpath, base_name):
     path = os.path.join(dirpath, base_name)
@@ -52,15 +270,41 @@ def ensure_unique_path(dirpath, base_name):
         i += 1
 
 def download_file(file_url, out_path, retries=5):
+    # статусы повторяет адаптер; здесь — только обрывы посреди потока.
+    # Недокачанный out_path (в т.ч. от прошлого запуска) продолжаем с места обрыва
+    # через Range, а не с нуля; размер целиком узнаём заранее по HEAD.
+    # Сжатие выключаем (identity): иначе Content-Length и смещения Range считались бы
+    # в сжатых байтах, а размер на диске — в распакованных, и докачка портила бы файл
+    identity = {"Accept-Encoding": "identity"}
+    total = None
+    try:
+        h = dl_session.head(file_url, allow_redirects=True, timeout=REQ_TIMEOUT, headers=identity)
+        if h.ok and (h.headers.get("Content-Length") or "").isdigit():
+            total = int(h.headers["Content-Length"])
+    except requests.RequestException:
+        pass
     for a in range(retries):
+        start = os.path.getsize(out_path) if os.path.exists(out_path) else 0
+        if total is not None:
+            if start == total: return True
+            if start > total: start = 0  # чужой/битый хвост — качаем заново
+        headers = {**identity, "Range": f"bytes={start}-"} if start else identity
         try:
-            with session.get(file_url, stream=True, timeout=REQ_TIMEOUT) as r:
-                if r.status_code == 429:
-                    time.sleep(3 + a); continue
+            with dl_session.get(file_url, stream=True, timeout=REQ_TIMEOUT, headers=headers) as r:
+                if r.status_code == 416:
+                    # хвоста нет или файл не тот — следующая попытка начнёт с нуля
+                    os.remove(out_path)
+                    raise requests.HTTPError(f"416 Range Not Satisfiable: {file_url}")
                 r.raise_for_status()
-                with open(out_path, "wb") as f:
-                    for chunk in r.iter_content(1048576):
-                        if chunk: f.write(chunk)
+                r.raw.decode_content = True
+                # 206 — дописываем хвост; 200 — сервер Range проигнорировал, пишем с нуля
+                mode = "ab" if start and r.status_code == 206 else "wb"
+                # поток urllib3 → файл целиком в C-цикле, без своего буфера в Python
+                with open(out_path, mode, buffering=0) as f:
+                    shutil.copyfileobj(r.raw, f, length=1 << 20)
+                    # файл повторно не читаем — просим ядро не держать его в page cache
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
             return True
         except Exception as e:
             if a == retries - 1:
@@ -68,6 +312,49 @@ def download_file(file_url, out_path, retries=5):
                 return False
             time.sleep(1 + a)
 
+def fetch_runs_with_analyses(samp):
+    """
+    runs сэмпла вместе с их analyses одним составным запросом JSON:API
+    (/samples/{id}?include=runs,runs.analyses) вместо цепочки samples→runs→analyses.
+    Возвращает [(run, analyses | None)]; None — analyses рана в included не пришли,
+    их надо добрать по ссылке run → analyses.
+    Если API include не отдаёт (4xx или нет ключа included) — выключаем его
+    до конца запуска и ходим по ссылкам, как раньше. Сетевой сбой (в т.ч.
+    RetryError после исчерпанных 429/5xx) — только этот сэмпл идёт по ссылкам.
+    """
+    global INCLUDE_RELATED
+    sid = samp.get("id")
+    if INCLUDE_RELATED and sid:
+        try:
+            doc = get_json(f"{BASE}/samples/{_quote(sid)}",
+                           params={"include": "runs,runs.analyses"}) or {}
+        except requests.HTTPError:
+            doc = {}
+        except requests.RequestException as e:
+            print(f"[warn] include для {sid}: {e} — обход по ссылкам", file=sys.stderr)
+            doc = None
+        if doc is not None and "included" in doc:
+            included = doc.get("included") or []
+            runs = [x for x in included if x.get("type") == "runs" and
+                    (not RUN_EXPERIMENT_TYPE or
+                     (x.get("attributes") or {}).get("experiment-type") == RUN_EXPERIMENT_TYPE)]
+            by_run = {}
+            for x in included:
+                if x.get("type") != "analysis-jobs": continue
+                rid = ((((x.get("relationships") or {}).get("run") or {}).get("data")) or {}).get("id")
+                by_run.setdefault(rid, []).append(x)
+            return [(run, by_run.get(run.get("id"))) for run in runs]
+        if doc is not None:
+            INCLUDE_RELATED = False
+            print("[info] include= не поддержан API — обход по ссылкам", file=sys.stderr)
+
+    runs_link = (((samp.get("relationships") or {}).get("runs") or {}).get("links") or {}).get("related")
+    if not runs_link: return []
+    # фильтр по типу эксперимента — параметром запроса: лишние runs даже не приходят
+    params = {"experiment_type": RUN_EXPERIMENT_TYPE} if RUN_EXPERIMENT_TYPE else None
+    runs = get_json(runs_link, params=params) or {}
+    return [(run, None) for run in (runs.get("data") or [])]
+
 def find_biom_or_tsv(downloads_json):
     """
     FIX: Брать только реальные ссылки из downloads.
@@ -95,6 +382,77 @@ def locate_biom_cli():
     guess = os.path.join(sys.exec_prefix, "Scripts", "biom.exe")
     return guess if os.path.exists(guess) else None
 
+def write_biom_hdf5(biom_out_path, obs_ids, sample_ids, matrix, taxonomy=None):
+    """
+    Пишет BIOM 2.1 (HDF5) напрямую через h5py, без biom.Table и pandas:
+    атрибуты корня, observation/sample ids, матрица в обеих ориентациях
+    (CSR по наблюдениям, CSC = CSR по сэмплам), taxonomy — списком рангов.
+    """
+    import numpy as np, h5py
+    from datetime import datetime
+
+    csr = matrix.tocsr(); csr.sum_duplicates(); csr.sort_indices()
+    csc = matrix.tocsc(); csc.sum_duplicates(); csc.sort_indices()
+    str_dt = h5py.string_dtype()
+    with h5py.File(biom_out_path, "w") as f:
+        f.attrs["id"] = "No Table ID"
+        f.attrs["type"] = "OTU table"
+        f.attrs["format-url"] = "http://biom-format.org"
+        f.attrs["format-version"] = np.array([2, 1], dtype=np.int32)
+        f.attrs["generated-by"] = "mgnify-collector"
+        f.attrs["creation-date"] = datetime.now().isoformat()
+        f.attrs["shape"] = np.array(csr.shape, dtype=np.int32)
+        f.attrs["nnz"] = np.int32(csr.nnz)
+        for axis, ids, m in (("observation", obs_ids, csr), ("sample", sample_ids, csc)):
+            g = f.create_group(axis)
+            g.create_dataset("ids", data=np.array(ids, dtype=object), dtype=str_dt)
+            mg = g.create_group("matrix")
+            mg.create_dataset("data", data=m.data.astype(np.float64, copy=False))
+            mg.create_dataset("indices", data=m.indices.astype(np.int32, copy=False))
+            mg.create_dataset("indptr", data=m.indptr.astype(np.int32, copy=False))
+            g.create_group("metadata"); g.create_group("group-metadata")
+        if taxonomy is not None:
+            width = max((len(t) for t in taxonomy), default=0) or 1
+            ranks = np.array([t + [""] * (width - len(t)) for t in taxonomy], dtype=object)
+            f["observation/metadata"].create_dataset("taxonomy", data=ranks, dtype=str_dt)
+
+def read_otu_tsv(tsv_path):
+    """
+    OTU-таблица MGnify (TSV) → (obs_ids, sample_ids, coo_matrix, taxonomy | None).
+    Строки-комментарии ("# Constructed from biom file") пропускаем, заголовок —
+    "#OTU ID ..." или первая строка; колонка taxonomy идёт в метаданные.
+    Нули не храним: матрица собирается сразу разреженной.
+    """
+    import numpy as np
+    from scipy.sparse import coo_matrix
+
+    obs_ids, sample_ids, taxonomy, tax_col = [], None, [], None
+    rows, cols, vals = [], [], []
+    with open(tsv_path, newline="", encoding="utf-8") as f:
+        for rec in csv.reader(f, delimiter="\t"):
+            if not rec or not rec[0].strip(): continue
+            if sample_ids is None:
+                if rec[0].startswith("#") and not rec[0].upper().startswith("#OTU"): continue
+                sample_ids = [c.strip() for c in rec[1:]]
+                if sample_ids and sample_ids[-1].lower() == "taxonomy":
+                    tax_col = len(sample_ids) - 1; sample_ids.pop()
+                continue
+            if rec[0].startswith("#"): continue
+            r = len(obs_ids)
+            obs_ids.append(rec[0].strip())
+            for c, v in enumerate(rec[1:1 + len(sample_ids)]):
+                x = float(v) if v.strip() else 0.0
+                if x:
+                    rows.append(r); cols.append(c); vals.append(x)
+            if tax_col is not None:
+                tx = rec[1 + tax_col] if len(rec) > 1 + tax_col else ""
+                taxonomy.append([t.strip() for t in tx.split(";") if t.strip()])
+    if sample_ids is None:
+        raise ValueError(f"пустой TSV: {tsv_path}")
+    matrix = coo_matrix((np.asarray(vals, dtype=np.float64), (rows, cols)),
+                        shape=(len(obs_ids), len(sample_ids)))
+    return obs_ids, sample_ids, matrix, (taxonomy if tax_col is not None else None)
+
 def convert_tsv_to_biom(tsv_path, biom_out_path):
     biom_cli = locate_biom_cli()
     if biom_cli:
@@ -102,117 +460,253 @@ def convert_tsv_to_biom(tsv_path, biom_out_path):
                "--table-type=OTU table", "--to-hdf5"]
         subprocess.check_call(cmd)
         return True
-    # python fallback
+    # python fallback: TSV → разреженная матрица → BIOM 2.1 через h5py
     try:
-        import pandas as pd
-        from biom.table import Table
-        df = pd.read_csv(tsv_path, sep="\t", index_col=0)
-        table = Table(df.values,
-                      observation_ids=list(df.index.astype(str)),
-                      sample_ids=list(df.columns.astype(str)))
-        table.to_hdf5(biom_out_path, generated_by="mgnify-collector")
+        obs_ids, sample_ids, matrix, taxonomy = read_otu_tsv(tsv_path)
+        write_biom_hdf5(biom_out_path, obs_ids, sample_ids, matrix, taxonomy)
         return True
     except Exception as e:
         print(f"[!] TSV→BIOM fallback не удался: {e}", file=sys.stderr)
         return False
 
+def convert_tsv_job(tsv_path, biom_out_path):
+    # выполняется в ProcessPoolExecutor: конвертация + уборка TSV вне основного процесса
+    try:
+        return convert_tsv_to_biom(tsv_path, biom_out_path)
+    finally:
+        try: os.remove(tsv_path)
+        except OSError: pass
+
+# -------- манифест: analysis_id → имя файла (докачка после перезапуска) --------
+def _manifest_path(class_dir): return os.path.join(class_dir, ".manifest.json")
+
+def load_manifest(class_dir):
+    try:
+        with open(_manifest_path(class_dir), "r", encoding="utf-8") as f:
+            manifest = dict(json.load(f))
+    except (OSError, ValueError):
+        return {}
+    # записи о файлах, которых уже нет на диске, не считаем
+    return {an_id: name for an_id, name in manifest.items()
+            if os.path.exists(os.path.join(class_dir, name))}
+
+def save_manifest(class_dir, manifest):
+    # через временный файл + os.replace: при обрыве старый манифест остаётся целым
+    tmp = _manifest_path(class_dir) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, _manifest_path(class_dir))
+
+# Ctrl-C в main: гасит цепочки всех классов, идущих параллельно
+cancel_all = threading.Event()
+
 def harvest_class(class_name, lineage, n_target=TARGET_PER_CLASS):
     print(f"\n=== {class_name.upper()} ===")
-    start_ts = time.time(); saved = 0
+    start_ts = time.time()
     class_dir = os.path.join(OUT_DIR, class_name); os.makedirs(class_dir, exist_ok=True)
-    page_url = f"{BASE}/biomes/{quote(lineage, safe='')}/samples"
+    page_url = f"{BASE}/biomes/{_quote(lineage)}/samples"
+
+    # уже скачанные в прошлых запусках анализы не трогаем и сразу засчитываем
+    manifest = load_manifest(class_dir)
+    saved = len(manifest)
+    if saved:
+        print(f"[{class_name}] resume: уже есть {saved}/{n_target}")
+    if saved >= n_target:
+        print(f"Итого для {class_name}: {saved} файлов (цель достигнута).")
+        return saved
+
+    # сэмплы страницы обрабатываются параллельно: цель и имена файлов — под lock,
+    # stop гасит новые запросы, как только цель набрана (или случилась ошибка)
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def halted():
+        return stop.is_set() or cancel_all.is_set()
+
+    def commit(tmp_path, kind, an_id):
+        nonlocal saved
+        with lock:
+            if saved >= n_target or an_id in manifest:
+                # параллельная цепочка успела докачать лишний файл (или этот же анализ)
+                try: os.remove(tmp_path)
+                except OSError: pass
+                return
+            out_path = ensure_unique_path(class_dir, f"{class_name}_{saved+1}.biom")
+            os.replace(tmp_path, out_path)
+            manifest[an_id] = os.path.basename(out_path)
+            save_manifest(class_dir, manifest)
+            saved += 1
+            print(f"[{class_name}] {saved}/{n_target}: {os.path.basename(out_path)} ({kind})")
+            if saved >= n_target: stop.set()
+
+    # spawn, не fork: пул создаётся из потока класса, пока работают потоки сэмплов,
+    # prefetch и других классов — fork мог унести в ребёнка чужие захваченные блокировки
+    conv_pool = ProcessPoolExecutor(max_workers=CONVERT_WORKERS,
+                                    mp_context=multiprocessing.get_context("spawn"))
+
+    def on_converted(fut, tmp_tsv, tmp_biom, an_id):
+        if fut.cancelled():
+            for path in (tmp_tsv, tmp_biom):
+                try: os.remove(path)
+                except OSError: pass
+            return
+        try:
+            ok = fut.result()
+        except Exception as e:
+            print(f"[!] Ошибка конвертации {os.path.basename(tmp_tsv)}: {e}", file=sys.stderr)
+            ok = False
+        if ok:
+            commit(tmp_biom, "from TSV", an_id)
+        else:
+            try: os.remove(tmp_biom)
+            except OSError: pass
+
+    # Обход — конечный автомат: каждая стадия делает один запрос и возвращает
+    # следующие стадии (sample → run → analysis). Все они идут в общую очередь пула,
+    # поэтому сэмплы страницы продвигаются вперемешку, а не цепочка за цепочкой.
+    def stage_sample(samp):
+        if halted(): return []
+        return [functools.partial(stage_run, run, analyses)
+                for run, analyses in fetch_runs_with_analyses(samp)[:MAX_RUNS_PER_SAMPLE]]
+
+    def stage_run(run, analyses):
+        if halted(): return []
+        if analyses is None:
+            analyses_link = (((run.get("relationships") or {}).get("analyses") or {}).get("links") or {}).get("related")
+            if not analyses_link: return []
+            analyses = (get_json(analyses_link) or {}).get("data") or []
+        return [functools.partial(stage_analysis, an) for an in analyses[:MAX_ANALYSES_PER_RUN]]
+
+    def stage_analysis(an):
+        if halted(): return []
+        an_id = an.get("id")
+        if not an_id or an_id in manifest: return []  # без id не отследить; или скачан в прошлом запуске
+        dl_link = (((an.get("relationships") or {}).get("downloads") or {}).get("links") or {}).get("related")
+        if not dl_link: return []
+
+        downloads = get_json(dl_link) or {}
+        biom_url, biom_alias, tsv_url, tsv_alias = find_biom_or_tsv(downloads)
+
+        # DEBUG/лог: что реально нашли
+        if not biom_url and not tsv_url:
+            print(f"[{class_name}] skip analysis {an_id} — нет .biom и OTU .tsv")
+            return []
+
+        # временные имена по id анализа — параллельные цепочки не пересекаются
+        tmp_base = os.path.join(class_dir, f"__tmp_{class_name}_{an_id}")
+        tmp_biom = tmp_base + ".biom.tmp"  # не .biom — чтобы загрузчики не подхватили недокачанное
+
+        # 1) BIOM напрямую
+        if biom_url:
+            print(f"[{class_name}] download BIOM: {biom_alias} ← {biom_url}")
+            # при неудаче .tmp остаётся: следующий запуск докачает его через Range
+            if download_file(biom_url, tmp_biom):
+                commit(tmp_biom, "BIOM", an_id)
+            return []
+
+        # 2) OTU TSV → BIOM
+        tmp_tsv = tmp_base + ".tsv"
+        print(f"[{class_name}] download TSV:  {tsv_alias} ← {tsv_url}")
+        if download_file(tsv_url, tmp_tsv):
+            # конвертация уходит в процессы, стадии идут дальше по сети
+            fut = conv_pool.submit(convert_tsv_job, tmp_tsv, tmp_biom)
+            fut.add_done_callback(lambda f, t=tmp_tsv, b=tmp_biom, a=an_id: on_converted(f, t, b, a))
+        return []
+
+    def run_stage(step):
+        # сбой одной стадии (обрыв тела, битый JSON, исчерпанные ретраи) — в лог,
+        # без продолжений; остальные сэмплы класса идут дальше
+        try:
+            return step()
+        except Exception as e:
+            name = getattr(getattr(step, "func", step), "__name__", "stage")
+            print(f"[!] {class_name}: {name}: {e}", file=sys.stderr)
+            return []
 
     page_i = 0
-    for page in iter_pages(page_url):
-        page_i += 1
-        print(f"[{class_name}] page={page_i} saved={saved}")
-        if saved >= n_target: break
-        if CLASS_TIME_LIMIT and (time.time() - start_ts > CLASS_TIME_LIMIT):
-            print(f"[{class_name}] Достигнут лимит времени."); break
-        if page_i > MAX_SAMPLE_PAGES:
-            print(f"[{class_name}] Достигнут лимит страниц samples."); break
-
-        for samp in (page.get("data") or []):
-            if saved >= n_target: break
-            runs_link = (((samp.get("relationships") or {}).get("runs") or {}).get("links") or {}).get("related")
-            if not runs_link: continue
-            runs = get_json(runs_link) or {}
-            run_cnt = 0
-
-            for run in (runs.get("data") or []):
-                run_cnt += 1
-                if run_cnt > MAX_RUNS_PER_SAMPLE: break
-                if saved >= n_target: break
-
-                analyses_link = (((run.get("relationships") or {}).get("analyses") or {}).get("links") or {}).get("related")
-                if not analyses_link: continue
-                analyses = get_json(analyses_link) or {}
-                an_cnt = 0
-
-                for an in (analyses.get("data") or []):
-                    an_cnt += 1
-                    if an_cnt > MAX_ANALYSES_PER_RUN: break
-                    if saved >= n_target: break
-
-                    dl_link = (((an.get("relationships") or {}).get("downloads") or {}).get("links") or {}).get("related")
-                    if not dl_link: continue
-
-                    downloads = get_json(dl_link) or {}
-                    biom_url, biom_alias, tsv_url, tsv_alias = find_biom_or_tsv(downloads)
-
-                    # DEBUG/лог: что реально нашли
-                    if not biom_url and not tsv_url:
-                        print(f"[{class_name}] skip analysis {an.get('id')} — нет .biom и OTU .tsv")
-                        continue
-
-                    # 1) BIOM напрямую
-                    if biom_url:
-                        out_name = f"{class_name}_{saved+1}.biom"
-                        out_path = ensure_unique_path(class_dir, out_name)
-                        print(f"[{class_name}] download BIOM: {biom_alias} ← {biom_url}")
-                        if download_file(biom_url, out_path):
-                            saved += 1
-                            print(f"[{class_name}] {saved}/{n_target}: {os.path.basename(out_path)} (BIOM)")
-                        time.sleep(SLEEP)
-                        if saved >= n_target: break
-                        continue
-
-                    # 2) OTU TSV → BIOM
-                    if tsv_url:
-                        tmp_tsv = os.path.join(class_dir, f"__tmp_{class_name}_{saved+1}.tsv")
-                        out_name = f"{class_name}_{saved+1}.biom"
-                        out_path = ensure_unique_path(class_dir, out_name)
-                        print(f"[{class_name}] download TSV:  {tsv_alias} ← {tsv_url}")
-                        if download_file(tsv_url, tmp_tsv):
-                            try:
-                                if convert_tsv_to_biom(tmp_tsv, out_path):
-                                    saved += 1
-                                    print(f"[{class_name}] {saved}/{n_target}: {os.path.basename(out_path)} (from TSV)")
-                            finally:
-                                try: os.remove(tmp_tsv)
-                                except OSError: pass
-                            time.sleep(SLEEP)
-                            if saved >= n_target: break
-                        continue
-        # конец страницы
+    try:
+        with ThreadPoolExecutor(max_workers=SAMPLE_WORKERS) as pool:
+            for page in iter_pages(page_url, fetch=get_samples_page):
+                page_i += 1
+                print(f"[{class_name}] page={page_i} saved={saved}")
+                if halted(): break
+                if CLASS_TIME_LIMIT and (time.time() - start_ts > CLASS_TIME_LIMIT):
+                    print(f"[{class_name}] Достигнут лимит времени."); break
+                if page_i > MAX_SAMPLE_PAGES:
+                    print(f"[{class_name}] Достигнут лимит страниц samples."); break
+
+                pending = {pool.submit(run_stage, functools.partial(stage_sample, samp))
+                           for samp in (page.get("data") or [])}
+                try:
+                    while pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            pending.update(pool.submit(run_stage, step) for step in fut.result())
+                except BaseException:
+                    # Ctrl-C и прочее не-Exception — останавливаем остальные стадии и отдаём наверх
+                    stop.set(); raise
+            # конец страницы
+    except BaseException:
+        conv_pool.shutdown(wait=True, cancel_futures=True)
+        raise
+    # дожидаемся конвертаций: saved растёт в on_converted
+    conv_pool.shutdown(wait=True)
     print(f"Итого для {class_name}: {saved} файлов.")
     return saved
 
 def main():
     total = 0
-    for cname, lineage in BIOMES.items():
+    try:
+        socket.getaddrinfo(API_HOST, 443, 0, socket.SOCK_STREAM)  # резолвим заранее, один раз
+    except OSError as e:
+        print(f"[warn] DNS {API_HOST}: {e}", file=sys.stderr)
+    # все классы качаются одновременно поверх общего пула соединений и общего лимитера
+    with ThreadPoolExecutor(max_workers=max(1, len(BIOMES))) as pool:
+        futures = {pool.submit(harvest_class, cname, lineage, TARGET_PER_CLASS): cname
+                   for cname, lineage in BIOMES.items()}
         try:
-            total += harvest_class(cname, lineage, TARGET_PER_CLASS)
-        except subprocess.CalledProcessError as e:
-            print(f"[!] Ошибка конвертации для {cname}: {e}", file=sys.stderr)
+            for fut in as_completed(futures):
+                cname = futures[fut]
+                try:
+                    total += fut.result()
+                except subprocess.CalledProcessError as e:
+                    print(f"[!] Ошибка конвертации для {cname}: {e}", file=sys.stderr)
+                except Exception as e:
+                    print(f"[!] Ошибка на классе {cname}: {e}", file=sys.stderr)
         except KeyboardInterrupt:
-            print("\n[!] Прервано пользователем."); break
-        except Exception as e:
-            print(f"[!] Ошибка на классе {cname}: {e}", file=sys.stderr)
+            print("\n[!] Прервано пользователем.")
+            cancel_all.set()
     print(f"\nГотово: всего скачано {total} BIOM-файлов. Папка: {OUT_DIR}")
 
+def main_profiled(out_path):
+    # до 3.12 cProfile видит только свой поток: каждому новому потоку заводим свой
+    # профайлер и в конце сливаем всё в один файл для snakeviz/pstats.
+    # С 3.12 cProfile работает через sys.monitoring на весь процесс: второй
+    # prof.enable() падает с ValueError, а main_prof и так видит все потоки
+    import cProfile, pstats
+    profiles = []
+    per_thread = sys.version_info < (3, 12)
+
+    def start_thread_profile(frame, event, arg):
+        sys.setprofile(None)
+        prof = cProfile.Profile(); profiles.append(prof); prof.enable()
+
+    if per_thread:
+        threading.setprofile(start_thread_profile)
+    main_prof = cProfile.Profile()
+    try:
+        main_prof.runcall(main)
+    finally:
+        if per_thread:
+            threading.setprofile(None)
+        pstats.Stats(main_prof, *profiles).dump_stats(out_path)
+        print(f"[profile] {out_path}")
+
 if __name__ == "__main__":
-    main()
+    if PROFILE_OUT:
+        main_profiled(PROFILE_OUT)
+    else:
+        main()
 
 
 
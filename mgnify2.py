@@ -1,22 +1,30 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, sys, time, shutil, subprocess, re, json, hashlib
+import os, sys, io, time, csv, shutil, subprocess, json, hashlib, functools, threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from urllib.parse import quote
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ================== НАСТРОЙКИ ==================
 BASE = "https://www.ebi.ac.uk/metagenomics/api/v1"
 OUT_DIR = "biom_data"
 TARGET_PER_CLASS = 100
 REQ_TIMEOUT = 60
-SLEEP = 0.05
 
 # Лимиты обхода
 MAX_SAMPLE_PAGES     = 120
 MAX_RUNS_PER_SAMPLE  = 12
 MAX_ANALYSES_PER_RUN = 12
 CLASS_TIME_LIMIT     = 20*60*10  # None → снять лимит
+HARVEST_WORKERS      = 8      # сэмплов в обработке одновременно (runs → analyses → downloads)
+SIG_WORKERS          = os.cpu_count() or 1  # процессов под сигнатуры существующих файлов на resume
+STATE_FLUSH_EVERY    = 20     # .state.json пишется раз в N изменений…
+STATE_FLUSH_SECS     = 5      # …или раз в столько секунд, и всегда в конце класса
+CACHE_PATH           = "mgnify_cache.sqlite"  # кэш JSON-ответов API между запусками
+CACHE_TTL            = 86400  # сек; ETag/Last-Modified перепроверяются по cache_control
 
 # ДОБАВЬ СВОИ КЛАССЫ СЮДА
 BIOMES = {
@@ -24,98 +32,225 @@ BIOMES = {
 }
 
 # ===============================================
-session = requests.Session()
+try:
+    import requests_cache  # pip install requests-cache (необязательно)
+    session = requests_cache.CachedSession(CACHE_PATH, backend="sqlite", expire_after=CACHE_TTL,
+                                           allowable_methods=("GET",), allowable_codes=(200,),
+                                           cache_control=True)
+except ImportError:
+    session = requests.Session()
 session.headers.update({"Accept": "application/json"})
+# весь трафик идёт на один хост (www.ebi.ac.uk): пул с запасом под HARVEST_WORKERS
+# и одновременные скачивания, повторы 429/5xx с экспоненциальной паузой делает urllib3
+adapter = HTTPAdapter(
+    pool_connections=16, pool_maxsize=64,
+    max_retries=Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"]))
+# BIOM/TSV — крупные бинарники: качаем мимо кэша, через тот же пул соединений
+dl_session = requests.Session()
+for sess in (session, dl_session):
+    sess.headers["Connection"] = "keep-alive"  # соединения живут между запросами, без повторного TLS
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
 os.makedirs(OUT_DIR, exist_ok=True)
 
-IDX_RE = re.compile(r"^(?P<cls>[a-z_]+)_(?P<idx>\d+)\.biom$", re.IGNORECASE)
+try:
+    import ijson  # pip install ijson (необязательно): потоковый разбор страниц samples
+except ImportError:
+    ijson = None
+
+try:
+    import orjson  # pip install orjson (необязательно): разбор JSON в разы быстрее stdlib
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    from biom import load_table  # pip install biom-format: контентные сигнатуры BIOM
+    import numpy as np
+    _HAVE_BIOM = True
+except Exception:
+    _HAVE_BIOM = False
+
+try:
+    import xxhash  # pip install xxhash (необязательно): некриптографический хэш, в разы быстрее sha256
+    HASHER, SIG_ALGO = xxhash.xxh3_128, "xxh3_128"
+except ImportError:
+    HASHER, SIG_ALGO = hashlib.sha256, "sha256"
+SIG_ALGO += "/csr"  # схема сигнатуры: разреженная CSR (сигнатуры по dense-матрице несравнимы)
+
+@functools.lru_cache(maxsize=1024)
+def _quote(s):
+    # lineage/id → сегмент пути; одни и те же строки кодируются многократно
+    return quote(s, safe="")
 
 # -------- state --------
+def _lk(url):
+    # ключ seen_links: всегда stdlib blake2b-64 (16 hex), от наличия xxhash не зависит —
+    # иначе установка/удаление пакета молча обесценивала бы весь seen_links.log
+    return hashlib.blake2b(url.encode("utf-8"), digest_size=8).hexdigest()
+
 def _state_path(class_dir): return os.path.join(class_dir, ".state.json")
+def _seen_log_path(class_dir): return os.path.join(class_dir, "seen_links.log")
 
 def load_state(class_dir):
+    state = {"seen_links": set(), "hash_to_name": {}, "biom_sig_to_name": {}, "raw_to_sig": {},
+             "sig_cache": {}, "etag_to_name": {}, "name_to_link": {}}
     if os.path.exists(_state_path(class_dir)):
         try:
             data = json.load(open(_state_path(class_dir), "r", encoding="utf-8"))
-            return {
-                "seen_links": set(data.get("seen_links") or []),
+            # сигнатуры другим хэшем несравнимы — выбрасываем, пересчитаются на resume
+            same_algo = data.get("sig_algo", "sha256") == SIG_ALGO
+            state = {
+                "seen_links": set(data.get("seen_links") or []),  # старый формат: список в JSON
                 "hash_to_name": dict(data.get("hash_to_name") or {}),   # старый формат, пусть будет
-                "biom_sig_to_name": dict(data.get("biom_sig_to_name") or {}),
+                "biom_sig_to_name": dict(data.get("biom_sig_to_name") or {}) if same_algo else {},
+                "sig_cache": dict(data.get("sig_cache") or {}) if same_algo else {},
+                "etag_to_name": dict(data.get("etag_to_name") or {}),
+                "name_to_link": dict(data.get("name_to_link") or {}),
             }
         except Exception:
             pass
-    return {"seen_links": set(), "hash_to_name": {}, "biom_sig_to_name": {}}
+    # raw_to_sig не хранится отдельно: собирается из sig_cache, т.е. только по живым файлам
+    state["raw_to_sig"] = raw_to_sig_from(state["sig_cache"])
+    # seen_links живут в append-only логе: строка на ссылку, без сортировки и перезаписи
+    if os.path.exists(_seen_log_path(class_dir)):
+        with open(_seen_log_path(class_dir), "r", encoding="utf-8") as f:
+            state["seen_links"].update(line.rstrip("\n") for line in f if line.strip())
+    # источник каждого сохранённого файла — тоже «уже пройден», даже если лог потерян
+    state["seen_links"].update(state["name_to_link"].values())
+    # в set — только 64-битные ключи _lk(url) (16 hex); полные URL старых версий переводим
+    state["seen_links"] = {x if len(x) == 16 else _lk(x) for x in state["seen_links"]}
+    return state
+
+def migrate_seen_log(class_dir, state):
+    """Старый .state.json хранил seen_links списком — переносим их в лог до первого save_state."""
+    if state["seen_links"] and not os.path.exists(_seen_log_path(class_dir)):
+        with open(_seen_log_path(class_dir), "w", encoding="utf-8") as f:
+            f.write("".join(link + "\n" for link in state["seen_links"]))
+
+def raw_to_sig_from(sig_cache):
+    # записи старого формата [mtime_ns, size, sig] — без raw_digest, пропускаем
+    return {e[3]: e[2] for e in sig_cache.values() if len(e) > 3}
 
 def save_state(class_dir, state):
     data = {
-        "seen_links": sorted(state["seen_links"]),
         "hash_to_name": state["hash_to_name"],
         "biom_sig_to_name": state["biom_sig_to_name"],
+        "sig_cache": state["sig_cache"],   # fname → [mtime_ns, size, sig, raw_digest]
+        "etag_to_name": state["etag_to_name"],
+        "name_to_link": state["name_to_link"],   # fname → ссылка, с которой он скачан
+        "sig_algo": SIG_ALGO,
     }
-    with open(_state_path(class_dir), "w", encoding="utf-8") as f:
+    # пишем во временный файл и подменяем атомарно: Ctrl+C не оставит половину JSON
+    tmp = _state_path(class_dir) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, _state_path(class_dir))
+    state["_dirty"] = False
+
+def mark_dirty(state):
+    state["_dirty"] = True
 
 # -------- helpers --------
 def next_index_for_class(class_dir: str, class_name: str) -> int:
+    # {class}_{N}.biom: префикс/суффикс строками, без regex; scandir не делает stat
     max_idx = 0
     if not os.path.isdir(class_dir): return 1
-    for fname in os.listdir(class_dir):
-        m = IDX_RE.match(fname)
-        if not m: continue
-        if m.group("cls").lower() != class_name.lower(): continue
-        try:
-            max_idx = max(max_idx, int(m.group("idx")))
-        except ValueError:
-            pass
+    pref = class_name.lower() + "_"
+    with os.scandir(class_dir) as it:
+        for e in it:
+            low = e.name.lower()
+            if not low.endswith(".biom") or not low.startswith(pref): continue
+            idx = low[len(pref):-5]
+            if idx.isdecimal():  # как \d+ в старом IDX_RE; isdigit() пропустил бы '²' — int() упадёт
+                max_idx = max(max_idx, int(idx))
     return max_idx + 1
 
-def get_json(url, params=None, retries=5):
-    for a in range(retries):
-        try:
-            r = session.get(url, params=params, timeout=REQ_TIMEOUT)
-            if r.status_code == 429:
-                time.sleep(3 + a); continue
-            r.raise_for_status()
-            return r.json()
-        except Exception:
-            if a == retries - 1: raise
-            time.sleep(1 + a)
-
-def iter_pages(url, params=None):
-    while url:
-        data = get_json(url, params=params)
-        if not data: break
-        yield data
-        url = (data.get("links") or {}).get("next")
+def get_json(url, params=None):
+    r = session.get(url, params=params, timeout=REQ_TIMEOUT)
+    r.raise_for_status()
+    return json_loads(r.content)
+
+def iter_pages(url, params=None, fetch=get_json):
+    # следующая страница запрашивается в фоне, пока вызывающий разбирает текущую
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        data = fetch(url, params=params) if url else None
+        while data:
+            next_url = (data.get("links") or {}).get("next")
+            fut = prefetch.submit(fetch, next_url) if next_url else None
+            yield data
+            data = fut.result() if fut else None
+
+def get_samples_page(url, params=None):
+    """
+    Страница samples, разобранная потоково через ijson: из тяжёлых attributes/
+    relationships в dict попадают только id сэмпла, ссылка на его runs и links.next.
+    Без ijson — обычный get_json.
+    """
+    if ijson is None:
+        return get_json(url, params)
+    r = session.get(url, params=params, stream=True, timeout=REQ_TIMEOUT)
+    with r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        # CachedSession уже вычитал тело в кэш — тогда разбираем его из памяти
+        src = io.BytesIO(r.content) if hasattr(session, "cache") else r.raw
+        items, next_url, cur = [], None, None
+        for prefix, event, value in ijson.parse(src, use_float=True):
+            if prefix == "data.item" and event == "start_map":
+                cur = {"id": None, "relationships": {"runs": {"links": {"related": None}}}}
+                items.append(cur)
+            elif prefix == "data.item.id":
+                cur["id"] = value
+            elif prefix == "data.item.relationships.runs.links.related":
+                cur["relationships"]["runs"]["links"]["related"] = value
+            elif prefix == "links.next":
+                next_url = value
+    return {"data": items, "links": {"next": next_url}}
+
+# альтернативные пути к тому же файлу на MGnify
+_REWRITES = (("/file/", "/download/"), ("/download/", "/file/"))
 
 def _try_url_variants(url: str):
-    variants = [url]
+    # генератор: следующий вариант строится, только если предыдущий не скачался
+    seen = {url}
+    yield url
     if url.endswith(".bio"):
-        variants.append(url + "m")
-    if "/file/" in url:
-        variants.append(url.replace("/file/", "/download/"))
-    if "/download/" in url:
-        variants.append(url.replace("/download/", "/file/"))
-    seen, out = set(), []
-    for v in variants:
-        if v not in seen:
-            out.append(v); seen.add(v)
-    return out
+        v = url + "m"; seen.add(v)
+        yield v
+    for a, b in _REWRITES:
+        if a in url:
+            v = url.replace(a, b)
+            if v not in seen:
+                seen.add(v)
+                yield v
+
+def head_etag(url):
+    """
+    Ключ содержимого по HEAD: "ETag|Content-Length". None — если HEAD не удался
+    или сервер не отдаёт ETag (тогда остаётся только контентная сигнатура).
+    """
+    try:
+        h = dl_session.head(url, allow_redirects=True, timeout=REQ_TIMEOUT)
+    except requests.RequestException:
+        return None
+    etag = h.headers.get("ETag") if h.ok else None
+    return f"{etag}|{h.headers.get('Content-Length', '')}" if etag else None
 
 def download_file_atomic(url, out_path, retries=5):
     tmp_path = out_path + ".part"
     for candidate in _try_url_variants(url):
         for a in range(retries):
             try:
-                with session.get(candidate, stream=True, timeout=REQ_TIMEOUT) as r:
-                    if r.status_code == 429:
-                        time.sleep(3 + a); continue
+                # статусы 429/5xx повторяет адаптер; цикл — на обрывы посреди потока
+                with dl_session.get(candidate, stream=True, timeout=REQ_TIMEOUT) as r:
                     if r.status_code == 404:
                         break
                     r.raise_for_status()
+                    r.raw.decode_content = True  # gzip/deflate, если сервер сжал, снимает urllib3
                     with open(tmp_path, "wb") as f:
-                        for chunk in r.iter_content(1048576):
-                            if chunk: f.write(chunk)
+                        shutil.copyfileobj(r.raw, f, length=1 << 20)  # цикл копирования — в C
                 os.replace(tmp_path, out_path)
                 return True, candidate
             except Exception as e:
@@ -129,56 +264,78 @@ def download_file_atomic(url, out_path, retries=5):
     return False, None
 
 # ---------- BIOM-сигнатура (контентная) ----------
+@functools.lru_cache(maxsize=1 << 16)
+def _dec(x):
+    # одни и те же OTU/ASV id повторяются от файла к файлу (resume-проход)
+    if isinstance(x, bytes):
+        try: return x.decode()
+        except Exception: return str(x)
+    return str(x)
+
 def compute_biom_signature(path):
     """
     Контентная сигнатура BIOM:
     - загружаем через biom.load_table()
-    - получаем dense DF (obs × samples)
-    - сортируем индексы (строки/столбцы)
-    - округляем до целых (OTU/ASV счётчики)
-    - sha256( row_ids || col_ids || matrix_bytes )
+    - берём родную разреженную матрицу (CSR, obs × samples), без pandas/dense
+    - переставляем строки/столбцы в порядке отсортированных id
+    - округляем до целых (OTU/ASV счётчики), явные нули выкидываем
+    - HASHER( row_ids || col_ids || indptr || indices || data ), xxh3_128 или sha256
+    Работа — O(nnz), а не O(obs × samples).
     """
-    try:
-        from biom import load_table
-        import numpy as np
-    except Exception as e:
+    if not _HAVE_BIOM:
         # biom не установлен — вернём None, чтобы не падать
         print("[warn] biom не установлен, контентная дедупликация отключена.", file=sys.stderr)
         return None
 
     tbl = load_table(path)  # авто JSON/HDF5
-    df = tbl.to_dataframe(dense=True)
-
-    # нормализуем имена
-    def dec(x): 
-        if isinstance(x, bytes):
-            try: return x.decode()
-            except Exception: return str(x)
-        return str(x)
-    df.index = df.index.map(dec)
-    df.columns = df.columns.map(dec)
-
-    # сортируем
-    df = df.sort_index(axis=0).sort_index(axis=1)
-
-    # к целым
-    arr = df.values
-    if issubclass(arr.dtype.type, (float,)):
-        arr = (arr + 0.0)  # make sure float
-        arr = np.rint(arr).astype("int64", copy=False)
-    else:
-        arr = arr.astype("int64", copy=False)
-
-    h = hashlib.sha256()
-    for rid in df.index:
-        h.update(rid.encode("utf-8")); h.update(b"\0")
-    h.update(b"|")
-    for cid in df.columns:
-        h.update(cid.encode("utf-8")); h.update(b"\0")
-    h.update(b"|")
-    h.update(arr.tobytes(order="C"))
+
+    # нормализуем имена: обычно это уже str — dec() только для bytes и прочего
+    obs_ids = [x if type(x) is str else _dec(x) for x in tbl.ids("observation")]
+    samp_ids = [x if type(x) is str else _dec(x) for x in tbl.ids("sample")]
+
+    # сортируем: перестановка строк и столбцов разреженной матрицы
+    obs_perm = np.argsort(np.array(obs_ids, dtype=str), kind="stable")
+    samp_perm = np.argsort(np.array(samp_ids, dtype=str), kind="stable")
+    M = tbl.matrix_data.tocsr()[obs_perm][:, samp_perm]
+    M.sum_duplicates()
+
+    # к целым: округляем на месте (M — уже своя копия после перестановки),
+    # новая память — только под int64
+    if M.data.dtype.kind == "f":
+        np.rint(M.data, out=M.data)
+    M.data = M.data.astype(np.int64, copy=False)
+    M.eliminate_zeros(); M.sort_indices()
+
+    # id — одним буфером на ось (те же байты "id\0id\0…|", что и поштучный update)
+    h = HASHER()
+    h.update("".join(obs_ids[i] + "\0" for i in obs_perm).encode("utf-8")); h.update(b"|")
+    h.update("".join(samp_ids[i] + "\0" for i in samp_perm).encode("utf-8")); h.update(b"|")
+    h.update(M.indptr.astype("int64", copy=False).tobytes())
+    h.update(M.indices.astype("int64", copy=False).tobytes())
+    h.update(M.data.tobytes())
     return h.hexdigest()
 
+def file_digest(path):
+    """
+    Хэш сырых байтов файла через hashlib.file_digest (для обычного файла это
+    цикл readinto/update с одним буфером, без bytes на каждый кусок).
+    Побайтно одинаковые файлы (один BIOM под /file/ и /download/) дают одну
+    контентную сигнатуру — её берём из state["raw_to_sig"] без biom.load_table.
+    """
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, HASHER).hexdigest()
+        h = HASHER()
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+        return h.hexdigest()
+
+def content_signature(path, raw_to_sig):
+    """(raw_digest, sig); запись в raw_to_sig — на вызывающем (он держит lock)."""
+    raw = file_digest(path)
+    sig = raw_to_sig.get(raw)
+    return raw, (sig if sig is not None else compute_biom_signature(path))
+
 # ---------- поиск .biom / OTU .tsv ----------
 def find_biom_or_tsv(downloads_json):
     biom_url = biom_alias = tsv_url = tsv_alias = None
@@ -203,6 +360,77 @@ def locate_biom_cli():
     guess = os.path.join(sys.exec_prefix, "Scripts", "biom.exe")
     return guess if os.path.exists(guess) else None
 
+def write_biom_hdf5(biom_out_path, obs_ids, sample_ids, matrix, taxonomy=None):
+    """
+    Пишет BIOM 2.1 (HDF5) напрямую через h5py, без biom.Table и pandas:
+    атрибуты корня, observation/sample ids, матрица в обеих ориентациях
+    (CSR по наблюдениям, CSC = CSR по сэмплам), taxonomy — списком рангов.
+    """
+    import numpy as np, h5py
+    from datetime import datetime
+
+    csr = matrix.tocsr(); csr.sum_duplicates(); csr.sort_indices()
+    csc = matrix.tocsc(); csc.sum_duplicates(); csc.sort_indices()
+    str_dt = h5py.string_dtype()
+    with h5py.File(biom_out_path, "w") as f:
+        f.attrs["id"] = "No Table ID"
+        f.attrs["type"] = "OTU table"
+        f.attrs["format-url"] = "http://biom-format.org"
+        f.attrs["format-version"] = np.array([2, 1], dtype=np.int32)
+        f.attrs["generated-by"] = "mgnify-collector"
+        f.attrs["creation-date"] = datetime.now().isoformat()
+        f.attrs["shape"] = np.array(csr.shape, dtype=np.int32)
+        f.attrs["nnz"] = np.int32(csr.nnz)
+        for axis, ids, m in (("observation", obs_ids, csr), ("sample", sample_ids, csc)):
+            g = f.create_group(axis)
+            g.create_dataset("ids", data=np.array(ids, dtype=object), dtype=str_dt)
+            mg = g.create_group("matrix")
+            mg.create_dataset("data", data=m.data.astype(np.float64, copy=False))
+            mg.create_dataset("indices", data=m.indices.astype(np.int32, copy=False))
+            mg.create_dataset("indptr", data=m.indptr.astype(np.int32, copy=False))
+            g.create_group("metadata"); g.create_group("group-metadata")
+        if taxonomy is not None:
+            width = max((len(t) for t in taxonomy), default=0) or 1
+            ranks = np.array([t + [""] * (width - len(t)) for t in taxonomy], dtype=object)
+            f["observation/metadata"].create_dataset("taxonomy", data=ranks, dtype=str_dt)
+
+def read_otu_tsv(tsv_path):
+    """
+    OTU-таблица MGnify (TSV) → (obs_ids, sample_ids, coo_matrix, taxonomy | None).
+    Строки-комментарии ("# Constructed from biom file") пропускаем, заголовок —
+    "#OTU ID ..." или первая строка; колонка taxonomy идёт в метаданные.
+    Нули не храним: матрица собирается сразу разреженной.
+    """
+    import numpy as np
+    from scipy.sparse import coo_matrix
+
+    obs_ids, sample_ids, taxonomy, tax_col = [], None, [], None
+    rows, cols, vals = [], [], []
+    with open(tsv_path, newline="", encoding="utf-8") as f:
+        for rec in csv.reader(f, delimiter="\t"):
+            if not rec or not rec[0].strip(): continue
+            if sample_ids is None:
+                if rec[0].startswith("#") and not rec[0].upper().startswith("#OTU"): continue
+                sample_ids = [c.strip() for c in rec[1:]]
+                if sample_ids and sample_ids[-1].lower() == "taxonomy":
+                    tax_col = len(sample_ids) - 1; sample_ids.pop()
+                continue
+            if rec[0].startswith("#"): continue
+            r = len(obs_ids)
+            obs_ids.append(rec[0].strip())
+            for c, v in enumerate(rec[1:1 + len(sample_ids)]):
+                x = float(v) if v.strip() else 0.0
+                if x:
+                    rows.append(r); cols.append(c); vals.append(x)
+            if tax_col is not None:
+                tx = rec[1 + tax_col] if len(rec) > 1 + tax_col else ""
+                taxonomy.append([t.strip() for t in tx.split(";") if t.strip()])
+    if sample_ids is None:
+        raise ValueError(f"пустой TSV: {tsv_path}")
+    matrix = coo_matrix((np.asarray(vals, dtype=np.float64), (rows, cols)),
+                        shape=(len(obs_ids), len(sample_ids)))
+    return obs_ids, sample_ids, matrix, (taxonomy if tax_col is not None else None)
+
 def convert_tsv_to_biom(tsv_path, biom_out_path):
     biom_cli = locate_biom_cli()
     if biom_cli:
@@ -210,14 +438,10 @@ def convert_tsv_to_biom(tsv_path, biom_out_path):
                "--table-type=OTU table", "--to-hdf5"]
         subprocess.check_call(cmd)
         return True
+    # python fallback: TSV → разреженная матрица → BIOM 2.1 через h5py
     try:
-        import pandas as pd
-        from biom.table import Table
-        df = pd.read_csv(tsv_path, sep="\t", index_col=0)
-        table = Table(df.values,
-                      observation_ids=list(df.index.astype(str)),
-                      sample_ids=list(df.columns.astype(str)))
-        table.to_hdf5(biom_out_path, generated_by="mgnify-collector")
+        obs_ids, sample_ids, matrix, taxonomy = read_otu_tsv(tsv_path)
+        write_biom_hdf5(biom_out_path, obs_ids, sample_ids, matrix, taxonomy)
         return True
     except Exception as e:
         print(f"[!] TSV→BIOM fallback не удался: {e}", file=sys.stderr)
@@ -231,16 +455,39 @@ def harvest_class(class_name, lineage, n_target=TARGET_PER_CLASS):
     os.makedirs(class_dir, exist_ok=True)
 
     state = load_state(class_dir)
-
-    # предварительно посчитаем сигнатуры для уже существующих файлов (если state пуст)
-    if not state["biom_sig_to_name"]:
-        for fname in sorted(os.listdir(class_dir)):
-            if not fname.lower().endswith(".biom"): continue
-            if not fname.startswith(class_name + "_"): continue
-            fpath = os.path.join(class_dir, fname)
-            sig = compute_biom_signature(fpath)
-            if sig:
-                state["biom_sig_to_name"].setdefault(sig, fname)
+    migrate_seen_log(class_dir, state)
+
+    # сигнатуры уже существующих файлов: неизменённые (тот же mtime/size) берём
+    # из sig_cache, BIOM перечитываем только для новых или переписанных
+    cache, fresh, todo = state["sig_cache"], {}, []
+    for fname in sorted(os.listdir(class_dir)):
+        if not fname.lower().endswith(".biom"): continue
+        if not fname.startswith(class_name + "_"): continue
+        st = os.stat(os.path.join(class_dir, fname))
+        hit = cache.get(fname)
+        if hit and hit[:2] == [st.st_mtime_ns, st.st_size]:
+            fresh[fname] = hit
+        else:
+            todo.append((fname, st))
+    # сырые digest'ы — здесь же, сверяем с raw_to_sig; разбор BIOM + хэш (чистый CPU)
+    # только для промахов, пачкой — по процессам: в пул уходит лишь путь к файлу
+    paths = [os.path.join(class_dir, fname) for fname, _ in todo]
+    raws = [file_digest(p) for p in paths]
+    miss = [p for p, raw in zip(paths, raws) if raw not in state["raw_to_sig"]]
+    if len(miss) > 4:
+        with ProcessPoolExecutor(max_workers=SIG_WORKERS) as ex:
+            sigs = dict(zip(miss, ex.map(compute_biom_signature, miss)))
+    else:
+        sigs = {p: compute_biom_signature(p) for p in miss}
+    for (fname, st), p, raw in zip(todo, paths, raws):
+        sig = state["raw_to_sig"].get(raw) or sigs.get(p)
+        if sig:
+            fresh[fname] = [st.st_mtime_ns, st.st_size, sig, raw]
+    for fname in sorted(fresh):
+        state["biom_sig_to_name"].setdefault(fresh[fname][2], fname)
+    state["raw_to_sig"] = raw_to_sig_from(fresh)  # удалённые файлы — вон и отсюда
+    if fresh != cache:
+        state["sig_cache"] = fresh  # заодно забываем удалённые файлы
         save_state(class_dir, state)
 
     next_idx = next_index_for_class(class_dir, class_name)
@@ -251,126 +498,167 @@ def harvest_class(class_name, lineage, n_target=TARGET_PER_CLASS):
         print(f"Итого для {class_name}: {saved} файлов (цель достигнута).")
         return saved
 
-    page_url = f"{BASE}/biomes/{quote(lineage, safe='')}/samples"
-    page_i = 0
-
-    for page in iter_pages(page_url):
-        page_i += 1
-        print(f"[{class_name}] page={page_i} saved={saved}")
-        if saved >= n_target: break
-        if CLASS_TIME_LIMIT and (time.time() - start_ts > CLASS_TIME_LIMIT):
-            print(f"[{class_name}] Достигнут лимит времени."); break
-        if page_i > MAX_SAMPLE_PAGES:
-            print(f"[{class_name}] Достигнут лимит страниц samples."); break
+    # state, next_idx и saved общие для потоков — меняются только под lock
+    lock = threading.Lock()
+    stop = threading.Event()
+    in_flight = set()  # ссылки, которые прямо сейчас качает другой поток
+
+    def halted():
+        if stop.is_set() or saved >= n_target: return True
+        return bool(CLASS_TIME_LIMIT) and time.time() - start_ts > CLASS_TIME_LIMIT
+
+    changes, flush_ts = 0, time.time()
+
+    def flush(force=False):
+        # вызывается под lock: json.dump — не на каждый файл
+        nonlocal changes, flush_ts
+        if not state.get("_dirty"): return
+        changes += 1
+        if force or changes >= STATE_FLUSH_EVERY or time.time() - flush_ts > STATE_FLUSH_SECS:
+            save_state(class_dir, state)
+            changes, flush_ts = 0, time.time()
+
+    def remember(link):
+        # под lock: ключ ссылки — в set и строкой в лог (line-buffered, переживает падение)
+        key = _lk(link)
+        state["seen_links"].add(key)
+        seen_fp.write(key + "\n")
+
+    def mark_seen(link):
+        with lock: remember(link)
+
+    def commit(tmp_path, link, kind, etag=None):
+        """Сигнатура — вне замка; проверка дубля, имя файла и rename — под ним."""
+        nonlocal saved, next_idx
+        # сигнатура считается ровно один раз на файл: и для проверки дубля, и для
+        # biom_sig_to_name/sig_cache. TSV-ветка сюда приходит уже с готовым BIOM,
+        # повторный разбор после конвертации не нужен
+        raw, sig = content_signature(tmp_path, state["raw_to_sig"])
+        with lock:
+            if sig: state["raw_to_sig"][raw] = sig
+            if sig and sig in state["biom_sig_to_name"]:
+                # дубликат — удаляем и НЕ увеличиваем индекс
+                try: os.remove(tmp_path)
+                except OSError: pass
+                remember(link)
+                if etag:
+                    state["etag_to_name"][etag] = state["biom_sig_to_name"][sig]
+            elif saved >= n_target:
+                # цель уже добрана соседями: файл лишний, но ссылку НЕ помечаем —
+                # при следующем запуске с большей целью анализ должен попасть в выборку
+                try: os.remove(tmp_path)
+                except OSError: pass
+            else:
+                remember(link)
+                out_name = f"{class_name}_{next_idx}.biom"
+                out_path = os.path.join(class_dir, out_name)
+                # os.replace не трогает байты: sig по tmp_path верна и для out_path, не пересчитываем
+                os.replace(tmp_path, out_path)
+                if sig:
+                    state["biom_sig_to_name"][sig] = out_name
+                    st = os.stat(out_path)
+                    state["sig_cache"][out_name] = [st.st_mtime_ns, st.st_size, sig, raw]
+                if etag:
+                    state["etag_to_name"][etag] = out_name
+                state["name_to_link"][out_name] = link
+                saved += 1; next_idx += 1
+                print(f"[{class_name}] {saved}/{n_target}: {out_name} ({kind})")
+            mark_dirty(state); flush()
+
+    def process_analysis(an):
+        dl_link = (((an.get("relationships") or {}).get("downloads") or {}).get("links") or {}).get("related")
+        if not dl_link: return
+        downloads = get_json(dl_link) or {}
+        biom_url, biom_alias, tsv_url, tsv_alias = find_biom_or_tsv(downloads)
+
+        # анти-дуб по ссылкам (чтобы не ходить повторно)
+        candidate_link = biom_url or tsv_url
+        if not candidate_link: return
+        with lock:
+            if _lk(candidate_link) in state["seen_links"] or candidate_link in in_flight: return
+            in_flight.add(candidate_link)
+        # временные имена — по id анализа: индекс назначается только в commit()
+        tmp_base = os.path.join(class_dir, f"__tmp_{class_name}_{an.get('id') or id(an)}")
+        try:
+            # тот же файл под другой ссылкой: ETag уже встречался — не качаем вовсе
+            etag = head_etag(candidate_link)
+            if etag:
+                with lock: dup = etag in state["etag_to_name"]
+                if dup:
+                    mark_seen(candidate_link)
+                    return
+            # ------- 1) прямой BIOM -------
+            if biom_url:
+                tmp_path = tmp_base + ".biom.tmp"
+                ok, used = download_file_atomic(biom_url, tmp_path)
+                if not ok:
+                    mark_seen(candidate_link)  # больше не пытаться
+                    return
+                commit(tmp_path, candidate_link, "BIOM", etag)
+                return
+
+            # ------- 2) TSV → BIOM -------
+            tmp_tsv, tmp_biom = tmp_base + ".tsv", tmp_base + ".biom.tmp"
+            ok, used = download_file_atomic(tsv_url, tmp_tsv)
+            if not ok:
+                mark_seen(candidate_link)
+                return
+            try:
+                if convert_tsv_to_biom(tmp_tsv, tmp_biom):
+                    commit(tmp_biom, candidate_link, "from TSV", etag)
+            finally:
+                for p in (tmp_tsv, tmp_biom):
+                    try: os.remove(p)
+                    except OSError: pass
+        finally:
+            with lock: in_flight.discard(candidate_link)
+
+    def process_sample(samp):
+        runs_link = (((samp.get("relationships") or {}).get("runs") or {}).get("links") or {}).get("related")
+        if not runs_link or halted(): return
+        runs = get_json(runs_link) or {}
+        for run in (runs.get("data") or [])[:MAX_RUNS_PER_SAMPLE]:
+            if halted(): return
+            analyses_link = (((run.get("relationships") or {}).get("analyses") or {}).get("links") or {}).get("related")
+            if not analyses_link: continue
+            analyses = get_json(analyses_link) or {}
+            for an in (analyses.get("data") or [])[:MAX_ANALYSES_PER_RUN]:
+                if halted(): return
+                process_analysis(an)
+
+    def run_sample(samp):
+        # ошибка одного сэмпла не останавливает соседей
+        try:
+            process_sample(samp)
+        except Exception as e:
+            print(f"[!] {class_name}/{samp.get('id')}: {e}", file=sys.stderr)
 
-        for samp in (page.get("data") or []):
+    page_url = f"{BASE}/biomes/{_quote(lineage)}/samples"
+    page_i = 0
+    seen_fp = open(_seen_log_path(class_dir), "a", buffering=1, encoding="utf-8")
+    pool = ThreadPoolExecutor(max_workers=HARVEST_WORKERS)
+    pending = set()
+    try:
+        for page in iter_pages(page_url, fetch=get_samples_page):
+            page_i += 1
+            print(f"[{class_name}] page={page_i} saved={saved}")
             if saved >= n_target: break
-
-            runs_link = (((samp.get("relationships") or {}).get("runs") or {}).get("links") or {}).get("related")
-            if not runs_link: continue
-            runs = get_json(runs_link) or {}
-            run_cnt = 0
-
-            for run in (runs.get("data") or []):
-                run_cnt += 1
-                if run_cnt > MAX_RUNS_PER_SAMPLE: break
-                if saved >= n_target: break
-
-                analyses_link = (((run.get("relationships") or {}).get("analyses") or {}).get("links") or {}).get("related")
-                if not analyses_link: continue
-                analyses = get_json(analyses_link) or {}
-                an_cnt = 0
-
-                for an in (analyses.get("data") or []):
-                    an_cnt += 1
-                    if an_cnt > MAX_ANALYSES_PER_RUN: break
-                    if saved >= n_target: break
-
-                    dl_link = (((an.get("relationships") or {}).get("downloads") or {}).get("links") or {}).get("related")
-                    if not dl_link: continue
-
-                    downloads = get_json(dl_link) or {}
-                    biom_url, biom_alias, tsv_url, tsv_alias = find_biom_or_tsv(downloads)
-
-                    # анти-дуб по ссылкам (чтобы не ходить повторно)
-                    candidate_link = biom_url or tsv_url
-                    if candidate_link and candidate_link in state["seen_links"]:
-                        continue
-
-                    # ------- 1) прямой BIOM -------
-                    if biom_url:
-                        out_name = f"{class_name}_{next_idx}.biom"
-                        out_path = os.path.join(class_dir, out_name)
-
-                        # качаем во временный .part, но с расширением .biom для совместимости с loader
-                        tmp_path = out_path + ".tmp"
-                        ok, used = download_file_atomic(biom_url, tmp_path)
-                        if not ok:
-                            state["seen_links"].add(candidate_link)  # больше не пытаться
-                            save_state(class_dir, state)
-                            continue
-
-                        # контентная сигнатура
-                        sig = compute_biom_signature(tmp_path)
-                        if sig and sig in state["biom_sig_to_name"]:
-                            # дубликат — удаляем и НЕ увеличиваем индекс
-                            try: os.remove(tmp_path)
-                            except OSError: pass
-                            state["seen_links"].add(candidate_link)
-                            save_state(class_dir, state)
-                            # print(f"[{class_name}] duplicate content → drop {out_name}")
-                            continue
-
-                        # уникальный — переименовываем
-                        os.replace(tmp_path, out_path)
-                        if sig:
-                            state["biom_sig_to_name"][sig] = out_name
-                        state["seen_links"].add(candidate_link)
-                        save_state(class_dir, state)
-
-                        saved += 1
-                        print(f"[{class_name}] {saved}/{n_target}: {out_name} (BIOM)")
-                        next_idx += 1
-                        time.sleep(SLEEP)
-                        if saved >= n_target: break
-                        continue
-
-                    # ------- 2) TSV → BIOM -------
-                    if tsv_url:
-                        tmp_tsv  = os.path.join(class_dir, f"__tmp_{class_name}_{next_idx}.tsv")
-                        ok, used = download_file_atomic(tsv_url, tmp_tsv)
-                        if not ok:
-                            state["seen_links"].add(candidate_link)
-                            save_state(class_dir, state)
-                            continue
-
-                        out_name = f"{class_name}_{next_idx}.biom"
-                        out_path = os.path.join(class_dir, out_name)
-
-                        try:
-                            if convert_tsv_to_biom(tmp_tsv, out_path):
-                                # сигнатура уже по BIOM
-                                sig = compute_biom_signature(out_path)
-                                if sig and sig in state["biom_sig_to_name"]:
-                                    # дубликат — удалить
-                                    try: os.remove(out_path)
-                                    except OSError: pass
-                                    state["seen_links"].add(candidate_link)
-                                    save_state(class_dir, state)
-                                    # print(f"[{class_name}] duplicate content (from TSV) → drop {out_name}")
-                                else:
-                                    if sig:
-                                        state["biom_sig_to_name"][sig] = out_name
-                                    state["seen_links"].add(candidate_link)
-                                    save_state(class_dir, state)
-                                    saved += 1
-                                    print(f"[{class_name}] {saved}/{n_target}: {out_name} (from TSV)")
-                                    next_idx += 1
-                                    time.sleep(SLEEP)
-                        finally:
-                            try: os.remove(tmp_tsv)
-                            except OSError: pass
-        # конец страницы
+            if CLASS_TIME_LIMIT and (time.time() - start_ts > CLASS_TIME_LIMIT):
+                print(f"[{class_name}] Достигнут лимит времени."); break
+            if page_i > MAX_SAMPLE_PAGES:
+                print(f"[{class_name}] Достигнут лимит страниц samples."); break
+
+            for samp in (page.get("data") or []):
+                pending.add(pool.submit(run_sample, samp))
+            # далеко вперёд по страницам не уходим: ждём, пока очередь не сократится
+            while len(pending) > 2 * HARVEST_WORKERS:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+        wait(pending)
+    finally:
+        stop.set()  # Ctrl+C/ошибка: рабочие потоки выходят на ближайшей проверке halted()
+        pool.shutdown(wait=True, cancel_futures=True)
+        with lock: flush(force=True)
+        seen_fp.close()
 
     print(f"Итого для {class_name}: {saved} файлов.")
     return saved
@@ -1,4 +1,5 @@
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
 
 BASE = "https://www.ebi.ac.uk/metagenomics/api/v1"
@@ -23,12 +24,20 @@ BIOMES = {
     "savanna":      "root:Environmental:Terrestrial:Soil:Savanna",
 }
 
-for name, lineage in BIOMES.items():
+session = requests.Session()  # одно keep-alive соединение на хост вместо TLS на каждый запрос
+
+def fetch(item):
+    name, lineage = item
     url = f"{BASE}/biomes/{quote(lineage, safe='')}"
     try:
-        r = requests.get(url, timeout=30)
+        r = session.get(url, timeout=30)
         r.raise_for_status()
         obj = r.json().get("data", {}).get("attributes", {})
-        print(f"{name:12s} → samples-count = {obj.get('samples-count')}  (lineage: {lineage})")
+        return f"{name:12s} → samples-count = {obj.get('samples-count')}  (lineage: {lineage})"
     except Exception as e:
-        print(f"{name:12s} → ERROR: {e}")
+        return f"{name:12s} → ERROR: {e}"
+
+# запросы независимы: все биомы разом, вывод — в порядке BIOMES
+with ThreadPoolExecutor(max_workers=10) as ex:
+    for line in ex.map(fetch, BIOMES.items()):
+        print(line)
@@ -28,47 +28,46 @@ def biom_to_df(table, dense=True):
     df.columns = df.columns.map(lambda x: x.decode() if isinstance(x, bytes) else x)
     return df
 
+def _deepest_rank(tx):
+    # список рангов: самый “глубокий” непустой, не 'NA'
+    return next((s for s in (str(t).strip() for t in reversed(tx) if t) if s and s != 'NA'), None)
+
 def extract_taxonomy(table):
     """
     Возвращает Series с таксономией для каждого observation_id.
     Пытается вытащить 'taxonomy' из метаданных (список рангов или строка).
     Если таксономии нет — подставляет сам observation_id.
+    Строковые операции — одним проходом pandas по всей колонке, а не по строке за раз.
     """
-    obs_ids = list(table.ids(axis='observation'))
+    obs_ids = [oid.decode() if isinstance(oid, bytes) else oid for oid in table.ids(axis='observation')]
     meta = table.metadata(axis='observation')
-    taxa = []
-
-    for oid, m in zip(obs_ids, meta if meta is not None else [None]*len(obs_ids)):
-        name = None
-        if isinstance(m, dict):
-            tx = m.get('taxonomy') or m.get('Taxonomy') or m.get('lineage')
-            if tx is not None:
-                # В MGnify taxonomy бывает списком рангов или строкой с ';'
-                if isinstance(tx, (list, tuple)):
-                    # берём самый “глубокий” ненулевой ранг
-                    tx_clean = [str(t).strip() for t in tx if t and str(t).strip() and str(t).strip() != 'NA']
-                    name = tx_clean[-1] if tx_clean else None
-                else:
-                    # строка: 'k__Bacteria; p__...; g__...; s__...'
-                    parts = [p.strip() for p in str(tx).split(';') if p.strip()]
-                    name = parts[-1] if parts else None
-        # если не получилось — fallback на id наблюдения
-        if not name:
-            name = oid.decode() if isinstance(oid, bytes) else str(oid)
-        taxa.append(name)
+    raw = pd.Series([(m.get('taxonomy') or m.get('Taxonomy') or m.get('lineage')) if isinstance(m, dict) else None
+                     for m in (meta if meta is not None else [None]*len(obs_ids))], dtype=object)
+
+    # В MGnify taxonomy бывает списком рангов или строкой с ';'
+    is_list = raw.map(lambda tx: isinstance(tx, (list, tuple))).to_numpy(dtype=bool)
+    is_str = ~is_list & raw.notna().to_numpy()
+    names = pd.Series(None, index=raw.index, dtype=object)
+    names[is_list] = raw[is_list].map(_deepest_rank)
+    # строка: 'k__Bacteria; p__...; g__...; s__...' → последний непустой ранг
+    names[is_str] = (raw[is_str].astype(str)
+                     .str.replace(r'[;\s]+$', '', regex=True)
+                     .str.split(';').str[-1].str.strip())
+
+    # если не получилось — fallback на id наблюдения
+    empty = names.isna().to_numpy() | (names == '').to_numpy()
+    names[empty] = pd.Series(obs_ids, dtype=object).astype(str)[empty]
 
     # чистим префиксы рангов (k__, p__, g__ и т.п.)
-    def strip_rank_prefix(s):
-        s = str(s)
-        if '__' in s[:4]:
-            return s.split('__', 1)[1] or s
-        return s
-    taxa = pd.Series([strip_rank_prefix(t) for t in taxa], index=[oid.decode() if isinstance(oid, bytes) else oid for oid in obs_ids], name='taxonomy')
+    taxa = names.str.replace(r'^.{0,2}?__(?=.)', '', regex=True).astype(str)
+    taxa.index = obs_ids
+    taxa.name = 'taxonomy'
     return taxa
 
-def top_taxa_overall(table, topn=20):
+def top_taxa_overall(table, topn=20, taxa=None):
     df = biom_to_df(table, dense=True)
-    taxa = extract_taxonomy(table)
+    if taxa is None:
+        taxa = extract_taxonomy(table)
     # сумма по всем сэмплам для каждого наблюдения
     totals = df.sum(axis=1)
     # агрегируем по таксон-имени
@@ -77,12 +76,13 @@ def top_taxa_overall(table, topn=20):
     out = pd.DataFrame({"abundance": agg, "relative": rel})
     return out.head(topn)
 
-def top_taxa_for_sample(table, sample_id, topn=20):
-    df = biom_to_df(table, dense=True)
-    if sample_id not in df.columns:
-        raise KeyError(f"Сэмпл {sample_id} не найден. Доступные: {list(df.columns)[:5]} ...")
-    taxa = extract_taxonomy(table)
-    counts = df[sample_id]
+def top_taxa_for_sample(table, sample_id, topn=20, taxa=None):
+    # нужен один столбец — берём только его, без dense-матрицы на всю таблицу
+    if not table.exists(sample_id, axis='sample'):
+        raise KeyError(f"Сэмпл {sample_id} не найден. Доступные: {[str(x) for x in table.ids(axis='sample')[:5]]} ...")
+    if taxa is None:
+        taxa = extract_taxonomy(table)
+    counts = pd.Series(np.asarray(table.data(sample_id, axis='sample', dense=True)).ravel(), index=taxa.index)
     agg = counts.groupby(taxa).sum().sort_values(ascending=False)
     rel = agg / agg.sum()
     out = pd.DataFrame({"abundance": agg, "relative": rel})
@@ -93,14 +93,15 @@ table = load_biom(PATH)
 table_info(table)
 
 # Топ таксонов по всей таблице (агрегировано по всем сэмплам)
-overall_top = top_taxa_overall(table, topn=20)
+taxa = extract_taxonomy(table)  # одна на оба топа
+overall_top = top_taxa_overall(table, topn=20, taxa=taxa)
 print("\nТоп-20 таксонов (общая абунд.):")
 print(overall_top)
 
 # Если хочешь — топ по конкретному сэмплу:
 samples = list(table.ids(axis='sample'))
 if samples:
-    sample_top = top_taxa_for_sample(table, samples[0], topn=15)
+    sample_top = top_taxa_for_sample(table, samples[0], topn=15, taxa=taxa)
     print(f"\nТоп-15 таксонов для сэмпла {samples[0]}:")
     print(sample_top)
 